@@ -0,0 +1,157 @@
+import argparse
+import os
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+DATABASE = "inventory.db"
+ARCHIVE_DIR = os.path.join("archive", "sales_history")
+ARCHIVE_AFTER_DAYS = 730
+CUTOFF_KEY = "sales_history_cutoff"
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("sale_date", pa.string()),
+    ("quantity", pa.int64()),
+    ("year", pa.int32()),
+    ("product_id", pa.int64()),
+])
+PARTITIONING = ds.partitioning(
+    pa.schema([("year", pa.int32()), ("product_id", pa.int64())]),
+    flavor="hive"
+)
+
+
+def init_archive_meta(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    conn.commit()
+
+
+def archive_cutoff(cursor):
+    """Every archived sale is dated before this (None when nothing was recorded)"""
+    cursor.execute("SELECT value FROM archive_meta WHERE key=?", (CUTOFF_KEY,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def archive_may_hold(cursor, start_date):
+    """Whether archived sales can fall in a window starting at start_date, so
+    recent windows skip opening the archive at all"""
+    if start_date is None:
+        return True
+    cutoff = archive_cutoff(cursor)
+    return cutoff is None or str(start_date) < cutoff
+
+
+def archive_sales_history(conn, cutoff_date, archive_dir=ARCHIVE_DIR, vacuum=True):
+    """Move sales older than cutoff_date into year/product_id partitioned Parquet files"""
+    cursor = conn.cursor()
+    cutoff = str(cutoff_date)
+
+    cursor.execute("""
+        SELECT product_id, sale_date, quantity FROM sales_history
+        WHERE sale_date < ?
+    """, (cutoff,))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    df = pd.DataFrame(rows, columns=["product_id", "sale_date", "quantity"])
+    df["year"] = df["sale_date"].str[:4].astype("int32")
+    table = pa.Table.from_pandas(df, schema=ARCHIVE_SCHEMA, preserve_index=False)
+
+    # Unique file names so repeated runs append to existing partitions
+    ds.write_dataset(
+        table,
+        archive_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore"
+    )
+
+    cursor.execute("DELETE FROM sales_history WHERE sale_date < ?", (cutoff,))
+    init_archive_meta(conn)
+    previous = archive_cutoff(cursor)
+    cursor.execute("INSERT OR REPLACE INTO archive_meta (key, value) VALUES (?, ?)",
+                   (CUTOFF_KEY, max(cutoff, previous or cutoff)))
+    conn.commit()
+    if vacuum:
+        conn.execute("VACUUM")
+    return len(rows)
+
+
+def archive_predicate(product_id=None, start_date=None, end_date=None):
+    predicate = ds.scalar(True)
+    if product_id is not None:
+        predicate &= ds.field("product_id") == product_id
+    if start_date is not None:
+        predicate &= ds.field("year") >= int(str(start_date)[:4])
+        predicate &= ds.field("sale_date") >= str(start_date)
+    if end_date is not None:
+        predicate &= ds.field("year") <= int(str(end_date)[:4])
+        predicate &= ds.field("sale_date") < str(end_date)
+    return predicate
+
+
+def load_archived_sales(product_id, start_date=None, end_date=None, archive_dir=ARCHIVE_DIR):
+    """Read archived sales for one product (or all when product_id is None),
+    pushing filters down to the Parquet scan"""
+    if not os.path.isdir(archive_dir):
+        return []
+
+    columns = ["sale_date", "quantity"]
+    if product_id is None:
+        columns = ["product_id"] + columns
+
+    dataset = ds.dataset(archive_dir, format="parquet", partitioning=PARTITIONING)
+    table = dataset.to_table(columns=columns,
+                             filter=archive_predicate(product_id, start_date, end_date))
+    return table.sort_by("sale_date").to_pylist()
+
+
+def iter_archived_sales(product_id=None, start_date=None, end_date=None,
+                        batch_size=5000, archive_dir=ARCHIVE_DIR):
+    """Yield archived (product_id, sale_date, quantity) rows in batches without
+    materialising the whole scan"""
+    if not os.path.isdir(archive_dir):
+        return
+
+    dataset = ds.dataset(archive_dir, format="parquet", partitioning=PARTITIONING)
+    for batch in dataset.to_batches(columns=["product_id", "sale_date", "quantity"],
+                                    filter=archive_predicate(product_id, start_date, end_date),
+                                    batch_size=batch_size):
+        if batch.num_rows:
+            yield list(zip(*(column.to_pylist() for column in batch.columns)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old sales_history rows to Parquet")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                        help="archive sales older than this many days")
+    parser.add_argument("--before", help="archive sales before this date (YYYY-MM-DD)")
+    parser.add_argument("--no-vacuum", action="store_true")
+    args = parser.parse_args()
+
+    if args.before:
+        cutoff_date = datetime.strptime(args.before, "%Y-%m-%d").date()
+    else:
+        cutoff_date = datetime.now().date() - timedelta(days=args.days)
+
+    conn = sqlite3.connect(DATABASE)
+    moved = archive_sales_history(conn, cutoff_date, vacuum=not args.no_vacuum)
+    conn.close()
+
+    print(f"Archived {moved} sales records before {cutoff_date} to {ARCHIVE_DIR}")
+
+
+if __name__ == "__main__":
+    main()
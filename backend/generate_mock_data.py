@@ -1,9 +1,11 @@
+import shutil
 import sqlite3
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
 from db import get_db
+from archive_sales import ARCHIVE_DIR
 import random
 
 def insert_products(conn):
@@ -54,9 +56,17 @@ def init_database():
     cursor = conn.cursor()
     
     # Drop existing tables
+    cursor.execute("DROP TABLE IF EXISTS stock_snapshots")
+    cursor.execute("DROP TABLE IF EXISTS forecast_cache")
+    cursor.execute("DROP TABLE IF EXISTS precompute_runs")
+    cursor.execute("DROP TABLE IF EXISTS sales_rollups")
+    cursor.execute("DROP TABLE IF EXISTS archive_meta")
     cursor.execute("DROP TABLE IF EXISTS transactions")
     cursor.execute("DROP TABLE IF EXISTS sales_history")
     cursor.execute("DROP TABLE IF EXISTS products")
+
+    # Archived partitions belong to the old product ids
+    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
     
     # Create tables
     cursor.execute("""
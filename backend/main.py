@@ -4,7 +4,9 @@
 # ===============================
 
 from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import sqlite3
@@ -12,8 +14,26 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import io
+import asyncio
+import csv
+import heapq
+import zlib
 import itertools
+import json
+import threading
 import warnings
+from concurrent.futures import Future
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from archive_sales import (
+    archive_may_hold,
+    init_archive_meta,
+    iter_archived_sales,
+    load_archived_sales,
+)
 
 from statsmodels.tsa.arima.model import ARIMA
 from statsmodels.tsa.stattools import adfuller
@@ -38,8 +58,8 @@ DATABASE = "inventory.db"
 # ===============================
 # Database
 # ===============================
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+def get_db(check_same_thread=True):
+    conn = sqlite3.connect(DATABASE, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -86,6 +106,66 @@ def init_db():
     )
     """)
 
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stock_snapshots (
+        product_id INTEGER,
+        snapshot_date DATE,
+        stock INTEGER,
+        PRIMARY KEY (product_id, snapshot_date),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+
+    # The cache only holds derived data, so an older layout is simply rebuilt
+    cur.execute("PRAGMA table_info(forecast_cache)")
+    cache_columns = {r["name"] for r in cur.fetchall()}
+    if cache_columns and not {"method", "granularity"} <= cache_columns:
+        cur.execute("DROP TABLE forecast_cache")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS forecast_cache (
+        product_id INTEGER,
+        periods INTEGER,
+        method TEXT,
+        granularity TEXT,
+        result TEXT,
+        computed_at TIMESTAMP,
+        PRIMARY KEY (product_id, periods, method, granularity),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sales_rollups (
+        product_id INTEGER,
+        granularity TEXT,
+        period_start DATE,
+        quantity INTEGER,
+        first_day DATE,
+        last_day DATE,
+        PRIMARY KEY (product_id, granularity, period_start),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_sales_history_product_date
+    ON sales_history (product_id, sale_date)
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_transactions_product_date
+    ON transactions (product_id, transaction_date)
+    """)
+
+    init_archive_meta(conn)
+
+    cur.execute("SELECT COUNT(*) FROM stock_snapshots")
+    if cur.fetchone()[0] == 0:
+        build_stock_snapshots(conn)
+
+    refresh_sales_rollups(conn)
+
     conn.commit()
     conn.close()
 
@@ -126,6 +206,83 @@ class SalesData(BaseModel):
     sale_date: str
     quantity: int
 
+# ===============================
+# Sales Loading (hot SQLite + archived Parquet)
+# ===============================
+def load_sales(cur, product_id, start_date=None):
+    if start_date is None:
+        cur.execute("""
+        SELECT sale_date,quantity FROM sales_history
+        WHERE product_id=? ORDER BY sale_date
+        """, (product_id,))
+    else:
+        cur.execute("""
+        SELECT sale_date,quantity FROM sales_history
+        WHERE product_id=? AND sale_date >= ? ORDER BY sale_date
+        """, (product_id, str(start_date)))
+    hot = [dict(r) for r in cur.fetchall()]
+
+    # Windows starting after the recorded archive cutoff never open the archive
+    if not archive_may_hold(cur, start_date):
+        return hot
+    archived = load_archived_sales(product_id, start_date)
+    if not archived:
+        return hot
+    return sorted(archived + hot, key=lambda r: r["sale_date"])
+
+# ===============================
+# Sales Rollups (weekly / monthly totals)
+# ===============================
+# Pandas period frequencies; weeks run Monday to Sunday
+ROLLUP_FREQS = {"week": "W-SUN", "month": "M"}
+FORECAST_GRANULARITIES = ("day",) + tuple(ROLLUP_FREQS)
+
+
+def refresh_sales_rollups(conn, product_id=None):
+    """Re-roll each product from its latest rolled period onwards"""
+    cur = conn.cursor()
+    if product_id is None:
+        cur.execute("SELECT id FROM products")
+        product_ids = [r[0] for r in cur.fetchall()]
+    else:
+        product_ids = [product_id]
+
+    for pid in product_ids:
+        for granularity, freq in ROLLUP_FREQS.items():
+            cur.execute("""
+            SELECT MAX(period_start) FROM sales_rollups
+            WHERE product_id=? AND granularity=?
+            """, (pid, granularity))
+            sales = load_sales(cur, pid, cur.fetchone()[0])
+            if not sales:
+                continue
+
+            df = pd.DataFrame(sales)
+            period = pd.to_datetime(df["sale_date"]).dt.to_period(freq)
+            rolled = df.groupby(period).agg(
+                quantity=("quantity", "sum"),
+                first_day=("sale_date", "min"),
+                last_day=("sale_date", "max")
+            )
+            cur.executemany("""
+            INSERT OR REPLACE INTO sales_rollups
+            (product_id, granularity, period_start, quantity, first_day, last_day)
+            VALUES (?,?,?,?,?,?)
+            """, [
+                (pid, granularity, str(p.start_time.date()), int(r.quantity), r.first_day, r.last_day)
+                for p, r in rolled.iterrows()
+            ])
+    conn.commit()
+
+
+def load_sales_rollup(cur, product_id, granularity, start_date=None):
+    cur.execute("""
+    SELECT period_start, quantity, first_day, last_day FROM sales_rollups
+    WHERE product_id=? AND granularity=? AND period_start >= ?
+    ORDER BY period_start
+    """, (product_id, granularity, str(start_date or "")))
+    return [dict(r) for r in cur.fetchall()]
+
 # ===============================
 # ARIMA + Inventory Logic
 # ===============================
@@ -154,21 +311,129 @@ def find_best_arima_params(data, max_p=3, max_d=2, max_q=3):
     return best_params
 
 
-def forecast_demand(sales_data, periods=30):
+def daily_sales_series(sales_data):
     df = pd.DataFrame(sales_data)
     df["sale_date"] = pd.to_datetime(df["sale_date"])
     df.set_index("sale_date", inplace=True)
 
-    daily_sales = df.resample("D")["quantity"].sum().fillna(0)
+    return df.resample("D")["quantity"].sum().fillna(0)
+
+
+# (period in time steps, number of sin/cos harmonics) per granularity; a season
+# is only fitted when the series covers FOURIER_MIN_CYCLES full cycles of it
+FOURIER_MIN_CYCLES = 2
+FOURIER_SEASONS = {
+    "day": ((7, 3), (365.25, 4)),
+    "week": ((365.25 / 7, 4),),
+    "month": ((12, 2),),
+}
+FORECAST_METHODS = ("arima", "fourier")
+
+
+@lru_cache(maxsize=64)
+def fourier_terms(length, periods, granularity="day"):
+    """Weekly and yearly sin/cos regressors for the fit window and the horizon,
+    or (None, None) when the window is too short for any season"""
+    t = np.arange(length + periods)
+    columns = []
+    for period, harmonics in FOURIER_SEASONS[granularity]:
+        if length < FOURIER_MIN_CYCLES * period:
+            continue
+        for k in range(1, harmonics + 1):
+            columns.append(np.sin(2 * np.pi * k * t / period))
+            columns.append(np.cos(2 * np.pi * k * t / period))
+
+    if not columns:
+        return None, None
 
-    order = find_best_arima_params(daily_sales.values)
-    model = ARIMA(daily_sales, order=order)
-    fit = model.fit()
+    exog = np.column_stack(columns)
+    exog.flags.writeable = False
+    return exog[:length], exog[length:]
 
-    forecast = np.maximum(fit.forecast(periods), 0)
-    ci = fit.get_forecast(periods).conf_int()
 
-    return forecast.tolist(), ci.values.tolist(), order
+def fit_and_forecast(series, periods, method="arima", granularity="day"):
+    exog = None
+    if method == "fourier":
+        exog, exog_future = fourier_terms(len(series), periods, granularity)
+
+    if exog is not None:
+        # Pick the order on the deseasonalised series so the grid search
+        # costs the same as plain ARIMA; only the final fit carries exog
+        design = np.column_stack([np.ones(len(series)), exog])
+        coef = np.linalg.lstsq(design, np.asarray(series), rcond=None)[0]
+        order = find_best_arima_params(np.asarray(series) - design @ coef)
+
+        fit = ARIMA(series, exog=exog, order=order).fit()
+        forecast = np.maximum(fit.forecast(periods, exog=exog_future), 0)
+        ci = fit.get_forecast(periods, exog=exog_future).conf_int()
+    else:
+        order = find_best_arima_params(np.asarray(series))
+        model = ARIMA(series, order=order)
+        fit = model.fit()
+
+        forecast = np.maximum(fit.forecast(periods), 0)
+        ci = fit.get_forecast(periods).conf_int()
+
+    forecast, ci = np.asarray(forecast), np.asarray(ci)
+    if not np.isfinite(ci).all():
+        # Short weekly/monthly series can leave the parameter covariance
+        # singular; fall back to a random-walk interval on the residuals
+        resid_std = np.asarray(fit.resid)[max(order[1], 1):].std()
+        half_width = stats.norm.ppf(0.975) * resid_std * np.sqrt(np.arange(1, periods + 1))
+        ci = np.column_stack([forecast - half_width, forecast + half_width])
+
+    return forecast, ci, order, fit
+
+
+def forecast_demand(sales_data, periods=30, method="arima"):
+    daily_sales = daily_sales_series(sales_data)
+    forecast, ci, order, _ = fit_and_forecast(daily_sales, periods, method)
+    return forecast.tolist(), ci.tolist(), order
+
+
+def rollup_series(rollup_rows, granularity):
+    freq = ROLLUP_FREQS[granularity]
+    rolled = pd.Series(
+        [r["quantity"] for r in rollup_rows],
+        index=pd.PeriodIndex([r["period_start"] for r in rollup_rows], freq=freq)
+    )
+    series = rolled.reindex(pd.period_range(rolled.index[0], rolled.index[-1], freq=freq),
+                            fill_value=0)
+
+    # Partial periods at either end would read as a demand drop
+    if str(series.index[0].start_time.date()) < rollup_rows[0]["first_day"]:
+        series = series.iloc[1:]
+    if str(series.index[-1].end_time.date()) > rollup_rows[-1]["last_day"]:
+        series = series.iloc[:-1]
+    return series
+
+
+def forecast_demand_rolled(rollup_rows, periods=30, method="arima", granularity="week"):
+    """Forecast on weekly/monthly totals, then spread back to `periods` daily values"""
+    series = rollup_series(rollup_rows, granularity)
+    first_day = pd.Timestamp(rollup_rows[-1]["last_day"]) + timedelta(days=1)
+    future = pd.period_range(series.index[-1] + 1,
+                             first_day + timedelta(days=periods - 1),
+                             freq=ROLLUP_FREQS[granularity])
+
+    forecast, ci, order, fit = fit_and_forecast(series.values.astype(float), len(future),
+                                                method, granularity)
+
+    # Spread each period evenly over its days and skip days already observed
+    lengths = np.array([(p.end_time.normalize() - p.start_time).days + 1 for p in future])
+    offset = (first_day - future[0].start_time).days
+    daily = np.repeat(forecast / lengths, lengths)[offset:offset + periods]
+    daily_ci = np.repeat(ci / lengths[:, None], lengths, axis=0)[offset:offset + periods]
+
+    period_forecast = [
+        {"period_start": str(p.start_time.date()), "quantity": float(f)}
+        for p, f in zip(future, forecast)
+    ]
+    # Daily noise implied by the per-period residuals, assuming independent days;
+    # the first residuals only reflect the differencing start-up
+    resid = np.asarray(fit.resid)[max(order[1], 1):]
+    demand_std = float(resid.std() / np.sqrt(np.mean(lengths)))
+    return daily.tolist(), daily_ci.tolist(), order, period_forecast, demand_std
 
 
 def calculate_eoq(annual_demand, ordering_cost, holding_cost):
@@ -185,6 +450,678 @@ def calculate_safety_stock(demand_std, lead_time_days, service_level=0.95):
 def calculate_rop(avg_daily_demand, lead_time_days, safety_stock):
     return round(avg_daily_demand * lead_time_days + safety_stock, 2)
 
+
+def calculate_inventory_policy(product, demand_std, forecast_values):
+    avg_daily_demand = float(np.mean(forecast_values))
+    annual_demand = avg_daily_demand * 365
+    holding_cost = (product["unit_cost"] or 0) * (product["holding_cost_percentage"] or 0)
+    lead_time_days = product["lead_time_days"] or 0
+
+    eoq = calculate_eoq(annual_demand, product["ordering_cost"] or 0, holding_cost)
+    safety_stock = calculate_safety_stock(demand_std, lead_time_days)
+    reorder_point = calculate_rop(avg_daily_demand, lead_time_days, safety_stock)
+
+    # Stock-independent, so it can be cached; see with_stock_status
+    return {
+        "eoq": float(eoq),
+        "safety_stock": float(safety_stock),
+        "reorder_point": float(reorder_point),
+        "avg_daily_demand": round(avg_daily_demand, 2),
+        "annual_demand": round(annual_demand, 2),
+        "demand_std": round(demand_std, 2)
+    }
+
+
+def with_stock_status(metrics, current_stock):
+    current_stock = current_stock or 0
+    return {
+        **metrics,
+        "current_stock": current_stock,
+        "stock_status": "ต้องสั่งซื้อ" if current_stock <= metrics["reorder_point"] else "ปกติ"
+    }
+
+
+def build_forecast(product, sales_data, periods=30, method="arima"):
+    forecast_values, ci, order = forecast_demand(sales_data, periods, method)
+
+    return {
+        "method": method,
+        "granularity": "day",
+        "arima": {"p": order[0], "d": order[1], "q": order[2]},
+        "forecast": forecast_values,
+        "confidence_intervals": ci,
+        "metrics": calculate_inventory_policy(
+            product, float(daily_sales_series(sales_data).std()), forecast_values
+        )
+    }
+
+
+def build_rolled_forecast(product, rollup_rows, periods=30, method="arima", granularity="week"):
+    forecast_values, ci, order, period_forecast, demand_std = forecast_demand_rolled(
+        rollup_rows, periods, method, granularity
+    )
+
+    return {
+        "method": method,
+        "granularity": granularity,
+        "arima": {"p": order[0], "d": order[1], "q": order[2]},
+        "forecast": forecast_values,
+        "confidence_intervals": ci,
+        "period_forecast": period_forecast,
+        "metrics": calculate_inventory_policy(product, demand_std, forecast_values)
+    }
+
+# ===============================
+# Forecast Cache
+# ===============================
+# Filled off-peak by precompute_forecasts.py; daytime requests read from here.
+DEFAULT_FORECAST_PERIODS = 30
+FORECAST_CACHE_MAX_AGE_HOURS = 36
+
+
+def load_cached_forecast(cur, product_id, periods, method="arima", granularity="day"):
+    cur.execute("""
+    SELECT result, computed_at FROM forecast_cache
+    WHERE product_id=? AND periods=? AND method=? AND granularity=?
+    """, (product_id, periods, method, granularity))
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    computed_at = datetime.strptime(row["computed_at"], "%Y-%m-%d %H:%M:%S")
+    if datetime.now() - computed_at > timedelta(hours=FORECAST_CACHE_MAX_AGE_HOURS):
+        return None
+
+    result = json.loads(row["result"])
+    result["computed_at"] = row["computed_at"]
+    return result
+
+
+def save_forecast(cur, product_id, periods, result, method="arima", granularity="day"):
+    cur.execute("""
+    INSERT OR REPLACE INTO forecast_cache
+    (product_id, periods, method, granularity, result, computed_at)
+    VALUES (?,?,?,?,?,?)
+    """, (product_id, periods, method, granularity, json.dumps(result),
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+# ===============================
+# Hierarchical Forecasting (category level)
+# ===============================
+# One model per category total instead of one per SKU. SKUs receive the
+# category forecast split by their recent share of category sales (top-down),
+# or keep their own forecasts and the category becomes their sum (bottom-up,
+# which fits no category model). Categories or SKUs with too little data are
+# returned with status "insufficient_data" instead of being dropped.
+HIERARCHY_SHARE_WINDOW_DAYS = 90
+RECONCILIATION_MODES = ("top_down", "bottom_up")
+UNCATEGORIZED = "Uncategorized"
+
+
+def load_sales_matrix(cur, start_date=None):
+    """Daily quantity per product (one column each) from a single sales query"""
+    if start_date is None:
+        cur.execute("SELECT product_id, sale_date, quantity FROM sales_history")
+    else:
+        cur.execute("""
+        SELECT product_id, sale_date, quantity FROM sales_history
+        WHERE sale_date >= ?
+        """, (str(start_date),))
+    df = pd.DataFrame([tuple(r) for r in cur.fetchall()],
+                      columns=["product_id", "sale_date", "quantity"])
+
+    archived = []
+    if archive_may_hold(cur, start_date):
+        archived = load_archived_sales(None, start_date)
+    if archived:
+        df = pd.concat([pd.DataFrame(archived), df], ignore_index=True)
+    if df.empty:
+        return df
+
+    df["sale_date"] = pd.to_datetime(df["sale_date"])
+    matrix = df.pivot_table(index="sale_date", columns="product_id", values="quantity",
+                            aggfunc="sum", fill_value=0)
+    return matrix.asfreq("D", fill_value=0)
+
+
+def daily_to_rollup_rows(series, granularity):
+    period = series.index.to_period(ROLLUP_FREQS[granularity])
+    days = pd.Series(series.index.strftime("%Y-%m-%d"), index=series.index)
+    first_day = days.groupby(period).min()
+    last_day = days.groupby(period).max()
+    return [
+        {"period_start": str(p.start_time.date()), "quantity": q,
+         "first_day": first_day[p], "last_day": last_day[p]}
+        for p, q in series.groupby(period).sum().items()
+    ]
+
+
+def forecast_series(series, periods, method, granularity):
+    if granularity == "day":
+        forecast, ci, order, _ = fit_and_forecast(series, periods, method)
+        return forecast, ci, order
+
+    forecast, ci, order, _, _ = forecast_demand_rolled(
+        daily_to_rollup_rows(series, granularity), periods, method, granularity
+    )
+    return np.array(forecast), np.array(ci), order
+
+
+def build_hierarchical_forecast(cur, periods=30, method="arima", granularity="day",
+                                reconciliation="top_down", start_date=None):
+    cur.execute("SELECT * FROM products")
+    products = {r["id"]: r for r in cur.fetchall()}
+
+    matrix = load_sales_matrix(cur, start_date)
+    if matrix.empty:
+        raise HTTPException(400, "Insufficient sales data")
+    # Products without sales in the window still get an (insufficient_data) entry
+    matrix = matrix.reindex(columns=list(products), fill_value=0)
+
+    category_of = pd.Series({pid: products[pid]["category"] or UNCATEGORIZED
+                             for pid in products})
+    totals = matrix.T.groupby(category_of).sum().T
+
+    # Recent share of category sales, falling back to the whole history
+    recent = matrix.iloc[-HIERARCHY_SHARE_WINDOW_DAYS:].sum()
+    overall = matrix.sum()
+    shares = recent / recent.groupby(category_of).transform("sum")
+    shares = shares.fillna(overall / overall.groupby(category_of).transform("sum")).fillna(0)
+    demand_std = matrix.std()
+
+    def sku_entry(pid, forecast=None, ci=None):
+        entry = {
+            "product_id": int(pid),
+            "code": products[pid]["code"],
+            "name": products[pid]["name"],
+            "share": round(float(shares[pid]), 4),
+            "status": "ok" if forecast is not None else "insufficient_data",
+            "forecast": None,
+            "confidence_intervals": None,
+            "metrics": None
+        }
+        if forecast is not None:
+            entry["forecast"] = forecast.tolist()
+            entry["confidence_intervals"] = ci.tolist()
+            entry["metrics"] = with_stock_status(
+                calculate_inventory_policy(products[pid], float(demand_std[pid]), forecast),
+                products[pid]["current_stock"]
+            )
+        return entry
+
+    categories = []
+    for category in totals.columns:
+        pids = category_of.index[category_of == category]
+        order = None
+
+        if reconciliation == "bottom_up":
+            # Cached forecasts cover the full history, so only a full-history
+            # request may reuse them
+            skus = []
+            for pid in pids:
+                cached = None
+                if start_date is None:
+                    cached = load_cached_forecast(cur, pid, periods, method, granularity)
+                if cached:
+                    skus.append(sku_entry(pid, np.array(cached["forecast"]),
+                                          np.array(cached["confidence_intervals"])))
+                elif (matrix[pid] > 0).sum() >= 10:
+                    sku_forecast, sku_ci, _ = forecast_series(matrix[pid], periods, method,
+                                                              granularity)
+                    skus.append(sku_entry(pid, sku_forecast, sku_ci))
+                else:
+                    skus.append(sku_entry(pid))
+
+            # Summing the SKU bounds gives a conservative category interval;
+            # SKUs without enough data contribute nothing
+            fitted = [sku for sku in skus if sku["status"] == "ok"]
+            forecast = ci = None
+            if fitted:
+                forecast = np.sum([sku["forecast"] for sku in fitted], axis=0)
+                ci = np.sum([sku["confidence_intervals"] for sku in fitted], axis=0)
+        elif (totals[category] > 0).sum() >= 10:
+            forecast, ci, order = forecast_series(totals[category], periods, method,
+                                                  granularity)
+            skus = [sku_entry(pid, forecast * shares[pid], ci * shares[pid])
+                    if overall[pid] > 0 else sku_entry(pid) for pid in pids]
+        else:
+            forecast = ci = None
+            skus = [sku_entry(pid) for pid in pids]
+
+        categories.append({
+            "category": category,
+            "status": "ok" if forecast is not None else "insufficient_data",
+            "arima": {"p": order[0], "d": order[1], "q": order[2]} if order else None,
+            "forecast": forecast.tolist() if forecast is not None else None,
+            "confidence_intervals": ci.tolist() if ci is not None else None,
+            "products": skus
+        })
+
+    return {
+        "method": method,
+        "granularity": granularity,
+        "reconciliation": reconciliation,
+        "categories": categories
+    }
+
+# ===============================
+# Forecast Admission (coalescing + priority queue)
+# ===============================
+# Identical concurrent requests share one in-flight computation. Everything
+# else waits in a bounded priority queue served by a fixed pool of workers;
+# when the queue is full new work is rejected with 503 instead of piling up.
+FORECAST_WORKERS = 2
+FORECAST_QUEUE_SIZE = 16
+FORECAST_RETRY_AFTER_SECONDS = 30
+FORECAST_PRIORITIES = {"interactive": 0, "batch": 1}
+
+forecast_cond = threading.Condition()
+forecast_queue = []
+forecast_inflight = {}
+# Keys of jobs waiting for a worker; forecast_queue may also hold stale
+# entries left behind by promotions, so it is not used for admission
+forecast_waiting = set()
+forecast_seq = itertools.count()
+forecast_workers = []
+
+
+def forecast_worker():
+    while True:
+        with forecast_cond:
+            while not forecast_queue:
+                forecast_cond.wait()
+            _, _, key, fn, future = heapq.heappop(forecast_queue)
+            # A promoted job leaves a stale lower-priority entry behind
+            if future.running() or future.done():
+                continue
+            future.set_running_or_notify_cancel()
+            forecast_waiting.discard(key)
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with forecast_cond:
+                forecast_inflight.pop(key, None)
+
+
+async def wait_forecast(future):
+    # Awaited rather than blocking a threadpool worker, so waiting requests
+    # cannot starve other sync routes. Shielded: one client disconnecting
+    # must not cancel a computation that other requests share
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+
+def submit_forecast(key, fn, priority="interactive"):
+    rank = FORECAST_PRIORITIES[priority]
+    with forecast_cond:
+        entry = forecast_inflight.get(key)
+        if entry:
+            future, queued_rank = entry
+            if rank < queued_rank and not future.running():
+                heapq.heappush(forecast_queue, (rank, next(forecast_seq), key, fn, future))
+                forecast_inflight[key] = (future, rank)
+                forecast_cond.notify()
+            return future
+
+        # Batch work may only fill half the queue so interactive requests still get in
+        limit = FORECAST_QUEUE_SIZE if rank == 0 else FORECAST_QUEUE_SIZE // 2
+        if len(forecast_waiting) >= limit:
+            raise HTTPException(
+                503, "Forecast service busy, retry later",
+                headers={"Retry-After": str(FORECAST_RETRY_AFTER_SECONDS)}
+            )
+
+        while len(forecast_workers) < FORECAST_WORKERS:
+            worker = threading.Thread(target=forecast_worker, daemon=True)
+            worker.start()
+            forecast_workers.append(worker)
+
+        future = Future()
+        forecast_inflight[key] = (future, rank)
+        forecast_waiting.add(key)
+        heapq.heappush(forecast_queue, (rank, next(forecast_seq), key, fn, future))
+        forecast_cond.notify()
+    return future
+
+# ===============================
+# Stock Ledger (snapshots + delta replay)
+# ===============================
+# A snapshot holds the closing stock of a product at the end of snapshot_date.
+# Point-in-time queries start from the nearest snapshot and only replay the
+# transactions between it and the requested date.
+SNAPSHOT_INTERVAL_DAYS = 7
+
+SIGNED_QUANTITY = "CASE WHEN transaction_type='in' THEN quantity ELSE -quantity END"
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(400, "Invalid date, expected YYYY-MM-DD")
+
+
+def net_movement(cur, product_id, after, until):
+    """Net stock change from transactions dated in (after, until]"""
+    cur.execute(f"""
+    SELECT COALESCE(SUM({SIGNED_QUANTITY}), 0) FROM transactions
+    WHERE product_id=? AND transaction_date >= ? AND transaction_date < ?
+    """, (product_id, str(after + timedelta(days=1)), str(until + timedelta(days=1))))
+    return cur.fetchone()[0]
+
+
+def build_stock_snapshots(conn, interval_days=SNAPSHOT_INTERVAL_DAYS):
+    """Backfill snapshots of closed days from the ledger, anchored on products.current_stock"""
+    cur = conn.cursor()
+    yesterday = datetime.now().date() - timedelta(days=1)
+
+    cur.execute("SELECT id, current_stock FROM products")
+    stocks = {r[0]: r[1] or 0 for r in cur.fetchall()}
+
+    cur.execute(f"""
+    SELECT product_id, date(transaction_date), SUM({SIGNED_QUANTITY})
+    FROM transactions GROUP BY product_id, date(transaction_date)
+    """)
+    moves = pd.DataFrame(cur.fetchall(), columns=["product_id", "day", "net"])
+    moves["day"] = pd.to_datetime(moves["day"]).dt.date
+
+    rows = []
+    for product_id, current_stock in stocks.items():
+        product_moves = moves[moves["product_id"] == product_id]
+        if product_moves.empty:
+            rows.append((product_id, str(yesterday), current_stock))
+            continue
+
+        # Walk backwards from yesterday: closing(d) = current - net moves after d.
+        # Today is still open, so it never gets a snapshot
+        day = yesterday
+        first_day = product_moves["day"].min() - timedelta(days=1)
+        while day >= first_day:
+            later = product_moves.loc[product_moves["day"] > day, "net"].sum()
+            rows.append((product_id, str(day), int(current_stock - later)))
+            day -= timedelta(days=interval_days)
+
+    cur.executemany("""
+    INSERT OR REPLACE INTO stock_snapshots (product_id, snapshot_date, stock)
+    VALUES (?,?,?)
+    """, rows)
+    conn.commit()
+
+
+def roll_stock_snapshot(cur, product_id, stock, interval_days=SNAPSHOT_INTERVAL_DAYS):
+    """Record yesterday's closing stock once the latest snapshot is a full interval old"""
+    yesterday = datetime.now().date() - timedelta(days=1)
+
+    cur.execute("SELECT MAX(snapshot_date) FROM stock_snapshots WHERE product_id=?",
+                (product_id,))
+    latest = cur.fetchone()[0]
+    if latest and parse_date(latest) > yesterday - timedelta(days=interval_days):
+        return
+
+    closing = stock - net_movement(cur, product_id, yesterday, yesterday + timedelta(days=1))
+    cur.execute("""
+    INSERT OR REPLACE INTO stock_snapshots (product_id, snapshot_date, stock)
+    VALUES (?,?,?)
+    """, (product_id, str(yesterday), closing))
+
+
+def stock_as_of(cur, product_id, current_stock, as_of):
+    today = datetime.now().date()
+    if as_of >= today:
+        return current_stock
+
+    cur.execute("""
+    SELECT snapshot_date, stock FROM stock_snapshots
+    WHERE product_id=? AND snapshot_date <= ?
+    ORDER BY snapshot_date DESC LIMIT 1
+    """, (product_id, str(as_of)))
+    before = cur.fetchone()
+
+    cur.execute("""
+    SELECT snapshot_date, stock FROM stock_snapshots
+    WHERE product_id=? AND snapshot_date > ? AND snapshot_date < ?
+    ORDER BY snapshot_date LIMIT 1
+    """, (product_id, str(as_of), str(today)))
+    after = cur.fetchone()
+
+    # Fall back to replaying backwards from the live stock figure
+    after_date, after_stock = (parse_date(after[0]), after[1]) if after else (today, current_stock)
+
+    if before:
+        before_date = parse_date(before[0])
+        if as_of - before_date <= after_date - as_of:
+            return before[1] + net_movement(cur, product_id, before_date, as_of)
+
+    return after_stock - net_movement(cur, product_id, as_of, after_date)
+
+
+def stock_curve(cur, product_id, current_stock, start, end):
+    opening = stock_as_of(cur, product_id, current_stock, start)
+
+    cur.execute(f"""
+    SELECT date(transaction_date) AS day, SUM({SIGNED_QUANTITY}) AS net
+    FROM transactions
+    WHERE product_id=? AND transaction_date >= ? AND transaction_date < ?
+    GROUP BY day
+    """, (product_id, str(start + timedelta(days=1)), str(end + timedelta(days=1))))
+    moves = {r["day"]: r["net"] for r in cur.fetchall()}
+
+    curve = [{"date": str(start), "stock": opening}]
+    stock = opening
+    day = start + timedelta(days=1)
+    while day <= end:
+        stock += moves.get(str(day), 0)
+        curve.append({"date": str(day), "stock": stock})
+        day += timedelta(days=1)
+    return curve
+
+# ===============================
+# Streaming Export
+# ===============================
+# Rows are pulled from SQLite with fetchmany and encoded chunk by chunk, so an
+# export never holds more than EXPORT_CHUNK_SIZE rows in memory.
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_FORMATS = ("csv", "parquet")
+
+SALES_EXPORT_SCHEMA = pa.schema([
+    ("product_id", pa.int64()),
+    ("sale_date", pa.string()),
+    ("quantity", pa.int64()),
+])
+FORECAST_EXPORT_SCHEMA = pa.schema([
+    ("product_id", pa.int64()),
+    ("code", pa.string()),
+    ("method", pa.string()),
+    ("granularity", pa.string()),
+    ("computed_at", pa.string()),
+    ("day", pa.int64()),
+    ("forecast", pa.float64()),
+    ("lower", pa.float64()),
+    ("upper", pa.float64()),
+])
+STOCK_EXPORT_SCHEMA = pa.schema([
+    ("product_id", pa.int64()),
+    ("code", pa.string()),
+    ("name", pa.string()),
+    ("category", pa.string()),
+    ("as_of", pa.string()),
+    ("stock", pa.int64()),
+])
+
+
+def fetch_chunks(cur, size=EXPORT_CHUNK_SIZE):
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            break
+        yield [tuple(r) for r in rows]
+
+
+class ExportSink(io.RawIOBase):
+    """Write-only file that hands back whatever was written since the last drain"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def encode_csv(schema, chunks, compress):
+    gz = zlib.compressobj(wbits=31) if compress else None
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    writer.writerow(schema.names)
+    for rows in chunks:
+        writer.writerows(rows)
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        data = gz.compress(data) if gz else data
+        if data:
+            yield data
+
+    if buf.getvalue():
+        data = buf.getvalue().encode("utf-8")
+        yield gz.compress(data) if gz else data
+    if gz:
+        yield gz.flush()
+
+
+def encode_parquet(schema, chunks, compress):
+    sink = ExportSink()
+    writer = pq.ParquetWriter(sink, schema, compression="gzip" if compress else "snappy")
+    try:
+        # Each chunk becomes one row group, flushed to the client straight away
+        for rows in chunks:
+            columns = [pa.array(values, type=field.type)
+                       for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_response(name, fmt, compress, schema, chunks):
+    if fmt == "csv":
+        body = encode_csv(schema, chunks, compress)
+        filename = f"{name}.csv.gz" if compress else f"{name}.csv"
+        media_type = "application/gzip" if compress else "text/csv"
+    else:
+        # Parquet compresses internally, so gzip selects the column codec
+        body = encode_parquet(schema, chunks, compress)
+        filename = f"{name}.parquet"
+        media_type = "application/vnd.apache.parquet"
+
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"'
+    })
+
+
+def sales_export_chunks(product_id, start_date, end_date, include_archive):
+    conn = get_db(check_same_thread=False)
+    try:
+        if include_archive and archive_may_hold(conn.cursor(), start_date):
+            archive_end = end_date + timedelta(days=1) if end_date else None
+            yield from iter_archived_sales(product_id, start_date, archive_end,
+                                           batch_size=EXPORT_CHUNK_SIZE)
+
+        query = "SELECT product_id, sale_date, quantity FROM sales_history WHERE 1=1"
+        params = []
+        if product_id is not None:
+            query += " AND product_id=?"
+            params.append(product_id)
+        if start_date is not None:
+            query += " AND sale_date >= ?"
+            params.append(str(start_date))
+        if end_date is not None:
+            query += " AND sale_date <= ?"
+            params.append(str(end_date))
+
+        yield from fetch_chunks(conn.execute(query + " ORDER BY sale_date", params))
+    finally:
+        conn.close()
+
+
+def forecast_export_chunks(method, granularity, include_stale=False):
+    """Cached forecasts, one row per forecast day. Entries older than the cache
+    max age are skipped unless include_stale, matching load_cached_forecast."""
+    conn = get_db(check_same_thread=False)
+    try:
+        where = " WHERE 1=1"
+        params = []
+        if method is not None:
+            where += " AND c.method=?"
+            params.append(method)
+        if granularity is not None:
+            where += " AND c.granularity=?"
+            params.append(granularity)
+        if not include_stale:
+            fresh_since = datetime.now() - timedelta(hours=FORECAST_CACHE_MAX_AGE_HOURS)
+            where += " AND c.computed_at >= ?"
+            params.append(fresh_since.strftime("%Y-%m-%d %H:%M:%S"))
+
+        # Each cache row expands to `periods` output rows, so fetch few enough
+        # cache rows that a chunk stays within EXPORT_CHUNK_SIZE
+        max_periods = conn.execute(
+            "SELECT MAX(c.periods) FROM forecast_cache c" + where, params
+        ).fetchone()[0]
+        if max_periods is None:
+            return
+        batch_size = max(1, EXPORT_CHUNK_SIZE // max_periods)
+
+        cursor = conn.execute("""
+        SELECT c.product_id, p.code, c.method, c.granularity, c.computed_at, c.result
+        FROM forecast_cache c JOIN products p ON p.id = c.product_id
+        """ + where, params)
+        for rows in fetch_chunks(cursor, batch_size):
+            out = []
+            for product_id, code, method_, granularity_, computed_at, result in rows:
+                result = json.loads(result)
+                for day, (value, (lower, upper)) in enumerate(
+                        zip(result["forecast"], result["confidence_intervals"]), start=1):
+                    out.append((product_id, code, method_, granularity_, computed_at,
+                                day, value, lower, upper))
+            yield out
+    finally:
+        conn.close()
+
+
+def stock_export_chunks(as_of):
+    conn = get_db(check_same_thread=False)
+    try:
+        ledger = conn.cursor()
+        cur = conn.execute("SELECT id, code, name, category, current_stock FROM products")
+        for rows in fetch_chunks(cur):
+            if as_of is None:
+                today = str(datetime.now().date())
+                yield [(pid, code, name, category, today, stock)
+                       for pid, code, name, category, stock in rows]
+            else:
+                yield [(pid, code, name, category, str(as_of),
+                        stock_as_of(ledger, pid, stock, as_of))
+                       for pid, code, name, category, stock in rows]
+    finally:
+        conn.close()
+
 # ===============================
 # Startup
 # ===============================
@@ -250,10 +1187,15 @@ def create_transaction(t: Transaction):
     if new_stock < 0:
         raise HTTPException(400, "Insufficient stock")
 
+    roll_stock_snapshot(cur, t.product_id, stock)
+
+    # Local time, matching the day boundaries the stock ledger uses
+    # (the column default CURRENT_TIMESTAMP would be UTC)
     cur.execute("""
-    INSERT INTO transactions (product_id,transaction_type,quantity,note)
-    VALUES (?,?,?,?)
-    """, (t.product_id, t.transaction_type, t.quantity, t.note))
+    INSERT INTO transactions (product_id,transaction_type,quantity,transaction_date,note)
+    VALUES (?,?,?,?,?)
+    """, (t.product_id, t.transaction_type, t.quantity,
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S"), t.note))
 
     cur.execute("UPDATE products SET current_stock=? WHERE id=?",
                 (new_stock, t.product_id))
@@ -262,34 +1204,209 @@ def create_transaction(t: Transaction):
     conn.close()
     return {"new_stock": new_stock}
 
+# ---------- Stock ----------
+@app.get("/api/stock/as-of")
+def get_stock_as_of(date: str, product_id: Optional[int] = None):
+    as_of = parse_date(date)
+
+    conn = get_db()
+    cur = conn.cursor()
+    if product_id is None:
+        cur.execute("SELECT id, code, name, current_stock FROM products")
+    else:
+        cur.execute("SELECT id, code, name, current_stock FROM products WHERE id=?",
+                    (product_id,))
+    products = cur.fetchall()
+    if product_id is not None and not products:
+        conn.close()
+        raise HTTPException(404, "Product not found")
+
+    data = [{
+        "product_id": p["id"],
+        "code": p["code"],
+        "name": p["name"],
+        "stock": stock_as_of(cur, p["id"], p["current_stock"], as_of)
+    } for p in products]
+    conn.close()
+    return {"date": str(as_of), "stock": data}
+
+@app.get("/api/stock/history/{product_id}")
+def get_stock_history(product_id: int, start: Optional[str] = None, end: Optional[str] = None):
+    end_date = parse_date(end) if end else datetime.now().date()
+    start_date = parse_date(start) if start else end_date - timedelta(days=90)
+    if start_date > end_date:
+        raise HTTPException(400, "start must not be after end")
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT current_stock FROM products WHERE id=?", (product_id,))
+    product = cur.fetchone()
+    if not product:
+        conn.close()
+        raise HTTPException(404, "Product not found")
+
+    curve = stock_curve(cur, product_id, product["current_stock"], start_date, end_date)
+    conn.close()
+    return {"product_id": product_id, "history": curve}
+
 # ---------- Forecast ----------
-@app.get("/api/forecast/{product_id}")
-def forecast(product_id: int):
+def compute_forecast(product_id, periods, history_days, method, granularity):
     conn = get_db()
     cur = conn.cursor()
 
     cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
     product = cur.fetchone()
-    if not product:
+
+    start_date = None
+    if history_days is not None:
+        start_date = datetime.now().date() - timedelta(days=history_days)
+
+    if granularity == "day":
+        sales = load_sales(cur, product_id, start_date)
+        if len(sales) < 10:
+            conn.close()
+            raise HTTPException(400, "Insufficient sales data")
+        result = build_forecast(product, sales, periods, method)
+    else:
+        refresh_sales_rollups(conn, product_id)
+        rollup = load_sales_rollup(cur, product_id, granularity, start_date)
+        if len(rollup) < 10:
+            conn.close()
+            raise HTTPException(400, "Insufficient sales data")
+        result = build_rolled_forecast(product, rollup, periods, method, granularity)
+
+    if history_days is None:
+        save_forecast(cur, product_id, periods, result, method, granularity)
+        conn.commit()
+    conn.close()
+    return result
+
+def compute_hierarchical_forecast(periods, history_days, method, granularity, reconciliation):
+    conn = get_db()
+    cur = conn.cursor()
+
+    start_date = None
+    if history_days is not None:
+        start_date = datetime.now().date() - timedelta(days=history_days)
+
+    try:
+        return build_hierarchical_forecast(cur, periods, method, granularity,
+                                           reconciliation, start_date)
+    finally:
+        conn.close()
+
+# Declared before /api/forecast/{product_id} so "hierarchical" is not taken as an id
+@app.get("/api/forecast/hierarchical")
+async def hierarchical_forecast(periods: int = DEFAULT_FORECAST_PERIODS,
+                                history_days: Optional[int] = None, method: str = "arima",
+                                granularity: str = "day", reconciliation: str = "top_down",
+                                priority: str = "interactive"):
+    if periods < 1:
+        raise HTTPException(400, "periods must be at least 1")
+    if method not in FORECAST_METHODS:
+        raise HTTPException(400, "method must be arima or fourier")
+    if granularity not in FORECAST_GRANULARITIES:
+        raise HTTPException(400, "granularity must be day, week or month")
+    if reconciliation not in RECONCILIATION_MODES:
+        raise HTTPException(400, "reconciliation must be top_down or bottom_up")
+    if priority not in FORECAST_PRIORITIES:
+        raise HTTPException(400, "priority must be interactive or batch")
+
+    key = ("hierarchical", periods, history_days, method, granularity, reconciliation)
+    future = submit_forecast(
+        key,
+        lambda: compute_hierarchical_forecast(periods, history_days, method, granularity,
+                                              reconciliation),
+        priority
+    )
+    return await wait_forecast(future)
+
+def load_product_forecast(product_id, periods, history_days, method, granularity):
+    """Cached forecast for a product, or None when it must be computed"""
+    conn = get_db()
+    cur = conn.cursor()
+
+    cur.execute("SELECT id FROM products WHERE id=?", (product_id,))
+    if not cur.fetchone():
+        conn.close()
         raise HTTPException(404, "Product not found")
 
-    cur.execute("""
-    SELECT sale_date,quantity FROM sales_history
-    WHERE product_id=? ORDER BY sale_date
-    """, (product_id,))
-    sales = [dict(r) for r in cur.fetchall()]
+    # Only full-history forecasts are precomputed
+    result = None
+    if history_days is None:
+        result = load_cached_forecast(cur, product_id, periods, method, granularity)
     conn.close()
+    return result
 
-    if len(sales) < 10:
-        raise HTTPException(400, "Insufficient sales data")
+def load_current_stock(product_id):
+    # Stock moves independently of the forecast, so it is always read live
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT current_stock FROM products WHERE id=?", (product_id,))
+    current_stock = cur.fetchone()["current_stock"]
+    conn.close()
+    return current_stock
 
-    forecast_values, ci, order = forecast_demand(sales)
+@app.get("/api/forecast/{product_id}")
+async def forecast(product_id: int, periods: int = DEFAULT_FORECAST_PERIODS,
+                   history_days: Optional[int] = None, method: str = "arima",
+                   granularity: str = "day", priority: str = "interactive"):
+    if periods < 1:
+        raise HTTPException(400, "periods must be at least 1")
+    if method not in FORECAST_METHODS:
+        raise HTTPException(400, "method must be arima or fourier")
+    if granularity not in FORECAST_GRANULARITIES:
+        raise HTTPException(400, "granularity must be day, week or month")
+    if priority not in FORECAST_PRIORITIES:
+        raise HTTPException(400, "priority must be interactive or batch")
 
-    return {
-        "arima": {"p": order[0], "d": order[1], "q": order[2]},
-        "forecast": forecast_values,
-        "confidence_intervals": ci
-    }
+    # SQLite calls block (up to the busy timeout), so they run off the event loop
+    result = await run_in_threadpool(load_product_forecast, product_id, periods, history_days,
+                                     method, granularity)
+    if result is None:
+        key = (product_id, periods, history_days, method, granularity)
+        future = submit_forecast(
+            key,
+            lambda: compute_forecast(product_id, periods, history_days, method, granularity),
+            priority
+        )
+        result = await wait_forecast(future)
+
+    current_stock = await run_in_threadpool(load_current_stock, product_id)
+    return {**result, "metrics": with_stock_status(result["metrics"], current_stock)}
+
+# ---------- Export ----------
+def check_export_format(fmt):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(400, "format must be csv or parquet")
+
+@app.get("/api/export/sales")
+def export_sales(format: str = "csv", gzip: bool = False, product_id: Optional[int] = None,
+                 start: Optional[str] = None, end: Optional[str] = None,
+                 include_archive: bool = True):
+    check_export_format(format)
+    start_date = parse_date(start) if start else None
+    end_date = parse_date(end) if end else None
+
+    return export_response("sales", format, gzip, SALES_EXPORT_SCHEMA,
+                           sales_export_chunks(product_id, start_date, end_date,
+                                               include_archive))
+
+@app.get("/api/export/forecasts")
+def export_forecasts(format: str = "csv", gzip: bool = False, method: Optional[str] = None,
+                     granularity: Optional[str] = None, include_stale: bool = False):
+    check_export_format(format)
+
+    return export_response("forecasts", format, gzip, FORECAST_EXPORT_SCHEMA,
+                           forecast_export_chunks(method, granularity, include_stale))
+
+@app.get("/api/export/stock")
+def export_stock(format: str = "csv", gzip: bool = False, date: Optional[str] = None):
+    check_export_format(format)
+    as_of = parse_date(date) if date else None
+
+    return export_response("stock", format, gzip, STOCK_EXPORT_SCHEMA,
+                           stock_export_chunks(as_of))
 
 # ===============================
 # Run local
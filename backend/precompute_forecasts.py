@@ -0,0 +1,174 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from main import (
+    DEFAULT_FORECAST_PERIODS,
+    FORECAST_CACHE_MAX_AGE_HOURS,
+    build_forecast,
+    get_db,
+    init_db,
+    load_sales,
+    save_forecast,
+)
+
+OFF_PEAK_START_HOUR = 1
+OFF_PEAK_END_HOUR = 5
+CPU_BUDGET = 0.5
+VELOCITY_WINDOW_DAYS = 30
+NEVER_COMPUTED_HOURS = 24 * 30
+
+
+def init_checkpoint(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS precompute_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            periods INTEGER,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+
+def start_or_resume_run(conn, periods):
+    """Resume the latest unfinished run, otherwise start a new one.
+
+    A run older than the cache max age is not resumed: the forecasts it already
+    refreshed have expired, and resuming would skip them.
+    """
+    cursor = conn.cursor()
+    resumable_since = datetime.now() - timedelta(hours=FORECAST_CACHE_MAX_AGE_HOURS)
+    cursor.execute("""
+        SELECT id, started_at FROM precompute_runs
+        WHERE periods=? AND finished_at IS NULL AND started_at >= ?
+        ORDER BY id DESC LIMIT 1
+    """, (periods, resumable_since.strftime("%Y-%m-%d %H:%M:%S")))
+    row = cursor.fetchone()
+    if row:
+        return row["id"], row["started_at"]
+
+    started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("INSERT INTO precompute_runs (periods, started_at) VALUES (?, ?)",
+                   (periods, started_at))
+    conn.commit()
+    return cursor.lastrowid, started_at
+
+
+def prioritized_products(conn, periods, run_started_at):
+    """Products still pending in this run, fastest-selling and stalest first"""
+    cursor = conn.cursor()
+    since = (datetime.now().date() - timedelta(days=VELOCITY_WINDOW_DAYS)).strftime("%Y-%m-%d")
+    cursor.execute("""
+        SELECT p.*, COALESCE(v.quantity, 0) AS velocity, c.computed_at
+        FROM products p
+        LEFT JOIN (
+            SELECT product_id, SUM(quantity) AS quantity FROM sales_history
+            WHERE sale_date >= ? GROUP BY product_id
+        ) v ON v.product_id = p.id
+        LEFT JOIN forecast_cache c
+            ON c.product_id = p.id AND c.periods = ? AND c.method = 'arima'
+            AND c.granularity = 'day'
+        WHERE c.computed_at IS NULL OR c.computed_at < ?
+    """, (since, periods, run_started_at))
+
+    now = datetime.now()
+
+    def priority(product):
+        if product["computed_at"] is None:
+            staleness = NEVER_COMPUTED_HOURS
+        else:
+            computed_at = datetime.strptime(product["computed_at"], "%Y-%m-%d %H:%M:%S")
+            staleness = (now - computed_at).total_seconds() / 3600
+        return (product["velocity"] + 1) * max(staleness, 1)
+
+    return sorted(cursor.fetchall(), key=priority, reverse=True)
+
+
+def in_off_peak_window(now, start_hour, end_hour):
+    if start_hour <= end_hour:
+        return start_hour <= now.hour < end_hour
+    return now.hour >= start_hour or now.hour < end_hour
+
+
+def run_precompute(periods=DEFAULT_FORECAST_PERIODS, cpu_budget=CPU_BUDGET, should_stop=None):
+    """Refresh every product's forecast once; returns True when the run completed"""
+    conn = get_db()
+    init_checkpoint(conn)
+    run_id, started_at = start_or_resume_run(conn, periods)
+
+    for product in prioritized_products(conn, periods, started_at):
+        if should_stop and should_stop():
+            conn.close()
+            return False
+
+        cpu_start = time.process_time()
+        cursor = conn.cursor()
+        sales = load_sales(cursor, product["id"])
+        if len(sales) >= 10:
+            # One degenerate series must not abort the rest of the catalogue
+            try:
+                result = build_forecast(product, sales, periods)
+            except Exception as e:
+                print(f"  {product['code']}: failed ({e})")
+            else:
+                save_forecast(cursor, product["id"], periods, result)
+                conn.commit()
+                print(f"  {product['code']}: refreshed")
+        else:
+            print(f"  {product['code']}: skipped (insufficient sales data)")
+
+        # Idle long enough that fitting uses at most cpu_budget of one core
+        cpu_used = time.process_time() - cpu_start
+        if 0 < cpu_budget < 1:
+            time.sleep(cpu_used * (1 / cpu_budget - 1))
+
+    conn.execute("UPDATE precompute_runs SET finished_at=? WHERE id=?",
+                 (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), run_id))
+    conn.commit()
+    conn.close()
+    return True
+
+
+def run_scheduler(start_hour=OFF_PEAK_START_HOUR, end_hour=OFF_PEAK_END_HOUR,
+                  periods=DEFAULT_FORECAST_PERIODS, cpu_budget=CPU_BUDGET):
+    """Run one precompute pass per off-peak window, forever"""
+    last_completed = None
+    while True:
+        now = datetime.now()
+        if in_off_peak_window(now, start_hour, end_hour) and last_completed != now.date():
+            print(f"Off-peak window open, precomputing forecasts ({now:%Y-%m-%d %H:%M})")
+            completed = run_precompute(
+                periods, cpu_budget,
+                should_stop=lambda: not in_off_peak_window(datetime.now(), start_hour, end_hour)
+            )
+            if completed:
+                last_completed = now.date()
+                print("✅ Precompute run completed")
+            else:
+                print("⏸️  Window closed, progress checkpointed")
+        time.sleep(60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute forecasts and inventory policies off-peak")
+    parser.add_argument("--once", action="store_true",
+                        help="run a single pass now, ignoring the off-peak window")
+    parser.add_argument("--start-hour", type=int, default=OFF_PEAK_START_HOUR)
+    parser.add_argument("--end-hour", type=int, default=OFF_PEAK_END_HOUR)
+    parser.add_argument("--periods", type=int, default=DEFAULT_FORECAST_PERIODS)
+    parser.add_argument("--cpu-budget", type=float, default=CPU_BUDGET,
+                        help="fraction of one CPU core to use (0-1]")
+    args = parser.parse_args()
+
+    init_db()
+
+    if args.once:
+        run_precompute(args.periods, args.cpu_budget)
+        print("✅ Precompute run completed")
+    else:
+        run_scheduler(args.start_hour, args.end_hour, args.periods, args.cpu_budget)
+
+
+if __name__ == "__main__":
+    main()